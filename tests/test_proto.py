@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from wsterm import proto
+
+
+def test_command_name():
+    assert proto.get_command_name(proto.EnumCommand.WRITE_STDOUT) == "write-stdout"
+    assert proto.get_command_name(proto.EnumCommand.SYNC_WORKSPACE) == "sync-workspace"
+    assert proto.get_command_name(100) == "100"
+
+
+def test_transport_packet():
+    message = {
+        "command": proto.EnumCommand.WRITE_STDIN,
+        "type": proto.EnumPacketType.REQUEST,
+        "id": 1,
+        "buffer": b"ls\n",
+    }
+    buffer = proto.TransportPacket(message).serialize()
+    packet, buffer = proto.TransportPacket.deserialize(buffer + b"\x00")
+    assert packet.message == message
+    assert buffer == b"\x00"
+    packet, buffer = proto.TransportPacket.deserialize(buffer)
+    assert packet is None
+
+
+def test_request_packer():
+    packer = proto.RequestPacker()
+    for _ in range(2):
+        buffer = packer.pack(proto.EnumCommand.WRITE_STDIN, 10, buffer=b"ls\n")
+        message = {
+            "command": proto.EnumCommand.WRITE_STDIN,
+            "type": proto.EnumPacketType.REQUEST,
+            "id": 10,
+            "buffer": b"ls\n",
+        }
+        assert buffer == proto.TransportPacket(message).serialize()
+
+
+def test_raw_command():
+    packer = proto.RequestPacker()
+    buffer = packer.pack(proto.EnumCommand.WRITE_STDOUT, 1, buffer=b"\x80hello")
+    assert buffer == b"\x00\x00\x00\x07\x0d\x80hello"
+    packet, buffer = proto.TransportPacket.deserialize(buffer)
+    assert packet.message == {
+        "command": proto.EnumCommand.WRITE_STDOUT,
+        "type": proto.EnumPacketType.REQUEST,
+        "buffer": b"\x80hello",
+    }
+    assert buffer == b""
+    assert packer.pack_raw(proto.EnumCommand.WRITE_STDOUT, [b"\x80he", b"llo"]) == (
+        b"\x00\x00\x00\x07\x0d\x80hello"
+    )
+
+
+def test_packet_reader():
+    packer = proto.RequestPacker()
+    buffer = packer.pack(proto.EnumCommand.WRITE_STDIN, 1, buffer=b"a")
+    buffer += packer.pack(proto.EnumCommand.WRITE_STDOUT, 2, buffer=b"b")
+    reader = proto.PacketReader()
+    reader.feed(buffer[:3])
+    assert reader.read_packet() is None
+    reader.feed(buffer[3:-1])
+    assert reader.read_packet().message["buffer"] == b"a"
+    assert reader.read_packet() is None
+    reader.feed(buffer[-1:])
+    assert reader.read_packet().message["buffer"] == b"b"
+    assert reader.read_packet() is None
+    buffer = packer.pack(proto.EnumCommand.WRITE_STDOUT, 3, buffer=b"c")
+    reader.feed(buffer + buffer[:2])
+    assert reader.read_packet().message["buffer"] == b"c"
+    assert reader.read_packet() is None
+    reader.feed(buffer[2:])
+    assert reader.read_packet().message["buffer"] == b"c"
+    assert reader.read_packet() is None
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from wsterm import server
+
+
+class FakeShell(object):
+    def __init__(self, name, exited):
+        self._name = name
+        self._exited = exited
+
+    def exit(self):
+        self._exited.append(self._name)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+async def test_shell_session_expire():
+    clock = FakeClock()
+    server.ShellSessionManager.reset()
+    ssm = server.ShellSessionManager(clock=clock)
+    try:
+        exited = []
+        sessions = {
+            name: ssm.create_session(FakeShell(name, exited), timeout)
+            for name, timeout in (("a", 20), ("b", 50), ("c", 20), ("d", 20))
+        }
+        for name in sessions:
+            ssm.update_session_time(sessions[name], clock.now)
+        ssm.update_session_time(sessions["d"], 0)  # Client reconnected
+        clock.now += 10
+        # Refreshed, must not be cleaned by the expiry entry of the first update
+        ssm.update_session_time(sessions["c"], clock.now)
+        assert ssm.clean_expired_sessions() == 1020
+
+        clock.now += 15
+        assert ssm.clean_expired_sessions() == 1030
+        assert exited == ["a"]
+        assert ssm.get_session(sessions["c"])
+        clock.now += 10
+        assert ssm.clean_expired_sessions() == 1050
+        assert exited == ["a", "c"]
+        clock.now += 20
+        assert ssm.clean_expired_sessions() is None
+        assert exited == ["a", "c", "b"]
+        assert ssm.get_session(sessions["a"]) is None
+        assert ssm.get_session(sessions["d"])
+    finally:
+        ssm.close()
+        server.ShellSessionManager.reset()
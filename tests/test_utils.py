@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+from wsterm import utils
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Requires add_reader on pipes")
+async def test_async_fd_concurrent_read():
+    rfd, wfd = os.pipe()
+    fd = utils.AsyncFileDescriptor(rfd)
+    reads = [asyncio.ensure_future(fd.read()) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    os.write(wfd, b"hello")
+    done, pending = await asyncio.wait(reads, timeout=0.5)
+    # The reader without data keeps waiting instead of seeing EOF
+    assert [it.result() for it in done] == [b"hello"]
+    os.close(wfd)
+    done, pending = await asyncio.wait(pending, timeout=0.5)
+    assert [it.result() for it in done] == [b""]
+    fd.close()
+    os.close(rfd)
+
+
+def _dir(dirs=None, files=None):
+    return {"dirs": dirs or {}, "files": files or {}}
+
+
+def test_diff_nested():
+    local = _dir(
+        {"a": _dir({"new": _dir()}, {"x": "h1", "y": "h2new"})}, {"r": "h3"}
+    )
+    remote = _dir({"a": _dir({"old": _dir()}, {"y": "h2", "z": "h4"})}, {"r": "h3"})
+    assert utils.diff(local, remote) == {
+        "dirs": {
+            "a": {
+                "dirs": {"new": _dir(), "old": "-"},
+                "files": {"x": "h1", "y": "h2new", "z": "-"},
+            }
+        }
+    }
+    assert utils.diff(local, local) == {}
+
+
+def test_diff_type_change():
+    as_dir = _dir({"b": _dir(files={"f": "h"})})
+    as_file = _dir(files={"b": "h"})
+    assert utils.diff(as_dir, as_file) == {
+        "dirs": {"b": _dir(files={"f": "h"})},
+        "files": {"b": "-"},
+    }
+    assert utils.diff(as_file, as_dir) == {
+        "dirs": {"b": "-"},
+        "files": {"b": "h"},
+    }
+
+
+def test_safe_import(monkeypatch, tmp_path):
+    paths = []
+    for index, source in enumerate(("", "import wsterm_fake_pkg.sub\nvalue = 1\n")):
+        path = str(tmp_path / str(index))
+        os.makedirs(os.path.join(path, "wsterm_fake_pkg"))
+        with open(os.path.join(path, "wsterm_fake_pkg", "__init__.py"), "w") as fp:
+            fp.write(source)
+        with open(os.path.join(path, "wsterm_fake_pkg", "sub.py"), "w") as fp:
+            fp.write("import wsterm_fake_pkg as parent\n")
+        paths.append(path)
+    monkeypatch.setattr(sys, "path", paths + sys.path)
+    monkeypatch.delitem(sys.modules, "wsterm_fake_pkg", raising=False)
+    monkeypatch.delitem(sys.modules, "wsterm_fake_pkg.sub", raising=False)
+    module = utils.safe_import("wsterm_fake_pkg", "value")
+    assert module.value == 1
+    assert sys.modules["wsterm_fake_pkg"] is module
+    assert module.sub.parent is module
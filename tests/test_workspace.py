@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
 import tempfile
 import time
 
+import pytest
+
 from wsterm import workspace
 
 
@@ -15,3 +19,76 @@ async def test_file():
     assert abs(file.last_modify_time - timestamp) < 0.1
     assert file.size == 10
     assert file.hash == "e807f1fcf82d132f9bb018ca6738a19f"
+
+
+def test_path_should_ignored(tmp_path):
+    root = str(tmp_path)
+    with open(os.path.join(root, ".gitignore"), "w") as fp:
+        fp.write("build/\n/dist\n*.log\nfoo/**/bar\n")
+    ws = workspace.Workspace(root)
+    for path in ("src/a.py", "src/dist", "foo/bar.txt"):
+        assert not ws.path_should_ignored(os.path.join(root, path))
+    for path in ("build", "src/build/a.o", "dist", "a.log", "foo/a/bar", "m.pyc"):
+        assert ws.path_should_ignored(os.path.join(root, path))
+
+
+def test_snapshot_hash_algo(tmp_path):
+    root = str(tmp_path)
+    with open(os.path.join(root, "a.txt"), "wb") as fp:
+        fp.write(b"1234567890")
+    ws = workspace.Workspace(root)
+    assert ws.snapshot()["files"]["a.txt"] == "e807f1fcf82d132f9bb018ca6738a19f"
+    for algo in workspace.HASH_ALGOS:
+        ws.hash_algo = algo
+        assert ws.snapshot()["files"]["a.txt"] == workspace.File(
+            os.path.join(root, "a.txt")
+        ).get_hash(algo)
+    with pytest.raises(ValueError):
+        ws.hash_algo = "unknown"
+
+
+def test_snapshot_reload_gitignore(tmp_path):
+    root = str(tmp_path)
+    for name in ("a.txt", "b.log"):
+        with open(os.path.join(root, name), "w") as fp:
+            fp.write(name)
+    ws = workspace.Workspace(root)
+    assert "b.log" in ws.snapshot()["files"]
+    with open(os.path.join(root, ".gitignore"), "w") as fp:
+        fp.write("*.log\n")
+    files = ws.snapshot()["files"]
+    assert "a.txt" in files and "b.log" not in files
+
+
+def test_snapshot_hash_batches(tmp_path):
+    root = str(tmp_path)
+    for i in range(10):
+        with open(os.path.join(root, "%d.txt" % i), "w") as fp:
+            fp.write("x" * (i % 3) * 4)
+    ws = workspace.Workspace(root)
+    ws.hash_batch_file_size = 8
+    ws.hash_batch_count = 2
+    files = ws.snapshot()["files"]
+    for i in range(10):
+        assert files["%d.txt" % i] == workspace.File(
+            os.path.join(root, "%d.txt" % i)
+        ).hash
+
+
+async def test_snapshot_hash_cache(tmp_path):
+    root = str(tmp_path)
+    os.mkdir(os.path.join(root, "sub"))
+    for name in ("a.txt", "sub/b.txt"):
+        with open(os.path.join(root, name), "w") as fp:
+            fp.write("1234")
+    ws = workspace.Workspace(root)
+    ws.snapshot()
+    with open(os.path.join(root, "a.txt"), "w") as fp:
+        fp.write("1234567890")
+    ws.on_file_modified("a.txt")
+    shutil.rmtree(os.path.join(root, "sub"))
+    ws.on_directory_removed("sub")
+    result = ws.snapshot()
+    assert result["files"]["a.txt"] == "e807f1fcf82d132f9bb018ca6738a19f"
+    assert result["dirs"] == {}
+    assert list(ws._hash_cache) == [os.path.join(ws.path, "a.txt")]
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import concurrent.futures
 import ctypes
 import os
 
@@ -26,9 +27,15 @@ class EnumWatchType(object):
 
 
 class Win32Watcher(WatcherBackendBase):
+    wait_timeout = 0.5
+
     def __init__(self, loop=None, filter=None):
         super(Win32Watcher, self).__init__(loop, filter)
         self._watch_list = []
+        # Waits block a thread each, keep them off the default executor
+        self._wait_executor = None
+        self._wait_workers = 0
+        self._wait_futures = {}  # group index => pending wait
         asyncio.ensure_future(self.polling_task())
         self._dir_tree = {}
 
@@ -222,7 +229,46 @@ class Win32Watcher(WatcherBackendBase):
                     self._add_dir_watch(item[2], item[4], item[3])
                     self._add_file_watch(item[2], item[4], item[3])
 
-            await asyncio.sleep(0.005)
+            await self._wait_for_changes()
+
+    async def _wait_for_changes(self):
+        """Block in worker threads until a pending read completes, instead
+        of polling the overlapped results
+
+        WaitForMultipleObjects takes at most MAXIMUM_WAIT_OBJECTS handles,
+        so every group of handles gets its own waiter.
+        """
+        events = [item[3].hEvent for item in self._watch_list]
+        if not events:
+            await asyncio.sleep(self.wait_timeout)
+            return
+        group_size = win32event.MAXIMUM_WAIT_OBJECTS
+        groups = (len(events) + group_size - 1) // group_size
+        if groups > self._wait_workers:
+            if self._wait_executor:
+                # Running waits still finish within wait_timeout
+                self._wait_executor.shutdown(wait=False)
+            self._wait_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=groups, thread_name_prefix="wsterm-watch"
+            )
+            self._wait_workers = groups
+        for index in range(groups):
+            if index not in self._wait_futures:
+                # Groups still waiting from last time are not waited twice
+                self._wait_futures[index] = self._loop.run_in_executor(
+                    self._wait_executor,
+                    win32event.WaitForMultipleObjects,
+                    events[index * group_size : (index + 1) * group_size],
+                    False,
+                    int(self.wait_timeout * 1000),
+                )
+        await asyncio.wait(
+            self._wait_futures.values(), return_when=asyncio.FIRST_COMPLETED
+        )
+        for index, future in list(self._wait_futures.items()):
+            if future.done():
+                self._wait_futures.pop(index)
+                future.result()
 
     async def read_event(self):
         move_from = None
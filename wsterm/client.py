@@ -5,6 +5,7 @@
 
 import asyncio
 import base64
+import itertools
 import json
 import os
 import random
@@ -24,6 +25,8 @@ WSTERM_MESSAGE_END_TAG = b"</WSTERM_MESSAGE>"
 
 
 class WSTerminalConnection(tornado.websocket.WebSocketClientConnection):
+    max_unclaimed_responses = 64
+
     def __init__(self, url, headers=None, timeout=15, handler=None):
         self._url = url
         self.__timeout = timeout
@@ -44,11 +47,21 @@ class WSTerminalConnection(tornado.websocket.WebSocketClientConnection):
             on_message_callback=self.on_message,
             compression_options=compression_options,
         )
-        self._buffer = b""
+        self._reader = proto.PacketReader()
         self._queue = asyncio.Queue()
         self._rsp_map = {}
+        self._rsp_waiters = {}
         self._read_event = asyncio.Event()
-        self._sequence = 0
+        self._sequence = itertools.count(1)
+        self._request_packer = proto.RequestPacker()
+        self._packet_handlers = {
+            proto.EnumPacketType.REQUEST: self.handle_request,
+            proto.EnumPacketType.RESPONSE: self.handle_response,
+        }
+        self._request_handlers = {
+            proto.EnumCommand.WRITE_STDOUT: self._handle_write_stdout,
+            proto.EnumCommand.EXIT_SHELL: self._handle_exit_shell,
+        }
 
     async def headers_received(self, start_line, headers):
         await super(WSTerminalConnection, self).headers_received(start_line, headers)
@@ -79,62 +92,77 @@ class WSTerminalConnection(tornado.websocket.WebSocketClientConnection):
 
     def on_message(self, message):
         if not message:
-            self._closed = True
+            self._close_queue()
         else:
-            self._buffer += message
-            packet, self._buffer = proto.TransportPacket.deserialize(self._buffer)
-            if packet:
+            self._reader.feed(message)
+            while True:
+                packet = self._reader.read_packet()
+                if not packet:
+                    break
                 self._queue.put_nowait(packet.message)
 
+    def _close_queue(self):
+        if not self._closed:
+            self._closed = True
+            # Wake up polling task to exit
+            self._queue.put_nowait(None)
+
     def on_connection_close(self):
-        self._closed = True
+        self._close_queue()
         if self._handler:
             self._handler.on_connection_close()
 
     async def polling_packet_task(self):
-        while not self._closed:
-            if self._queue.empty():
-                # Ensure the task exit in time
-                await asyncio.sleep(0.005)
-                continue
+        while True:
             packet = await self._queue.get()
-            if packet["type"] == proto.EnumPacketType.REQUEST:
-                await self.handle_request(packet)
-            elif packet["type"] == proto.EnumPacketType.RESPONSE:
-                await self.handle_response(packet)
+            if packet is None:
+                break
+            handler = self._packet_handlers.get(packet["type"])
+            if handler:
+                await handler(packet)
 
     async def handle_request(self, request):
-        if request["command"] == proto.EnumCommand.WRITE_STDOUT:
-            if self._handler:
-                await self._handler.on_shell_stdout(request["buffer"])
-        elif request["command"] == proto.EnumCommand.EXIT_SHELL:
-            if self._handler:
-                self._handler.on_shell_exit()
-        else:
-            raise NotImplementedError(request["command"])
+        handler = self._request_handlers.get(request["command"])
+        if not handler:
+            raise NotImplementedError(proto.get_command_name(request["command"]))
+        await handler(request)
+
+    async def _handle_write_stdout(self, request):
+        if self._handler:
+            await self._handler.on_shell_stdout(request["buffer"])
+
+    async def _handle_exit_shell(self, request):
+        if self._handler:
+            self._handler.on_shell_exit()
 
     async def handle_response(self, response):
+        waiter = self._rsp_waiters.pop(response["id"], None)
+        if waiter:
+            if not waiter.done():
+                waiter.set_result(response)
+            return
+        if len(self._rsp_map) >= self.max_unclaimed_responses:
+            # Drop the oldest response which is never read
+            self._rsp_map.pop(next(iter(self._rsp_map)))
         self._rsp_map[response["id"]] = response
 
     async def read_response(self, request, timeout=None):
-        time0 = time.time()
-        while not timeout or time.time() - time0 < timeout:
-            if request["id"] in self._rsp_map:
-                return self._rsp_map.pop(request["id"])
-            await asyncio.sleep(0.005)
-        return None
+        if request["id"] in self._rsp_map:
+            return self._rsp_map.pop(request["id"])
+        waiter = asyncio.get_running_loop().create_future()
+        self._rsp_waiters[request["id"]] = waiter
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._rsp_waiters.pop(request["id"], None)
 
     async def send_request(self, command, **kwargs):
-        self._sequence += 1
-        data = {
-            "command": command,
-            "type": proto.EnumPacketType.REQUEST,
-            "id": self._sequence,
-        }
-        data.update(kwargs)
-        packet = proto.TransportPacket(data)
-        await self.write_message(packet.serialize(), True)
-        return data
+        sequence = next(self._sequence)
+        buffer = self._request_packer.pack(command, sequence, **kwargs)
+        await self.write_message(buffer, True)
+        return {"command": command, "id": sequence}
 
     async def send_response(self, request, **kwargs):
         data = {
@@ -152,6 +180,8 @@ class WSTerminalClient(object):
 
     session_timeout = 10 * 60
     file_fragment_size = 4 * 1024 * 1024
+    min_poll_interval = 0.016
+    max_poll_interval = 0.1
 
     def __init__(self, url, token=None, timeout=15, loop=None, auto_reconnect=False):
         self._url = url
@@ -170,6 +200,7 @@ class WSTerminalClient(object):
         self._download_file = {}
         self._writing_files = {}
         self._shell_stdout_buffer = bytearray()
+        self._flush_pending = False
         utils.safe_ensure_future(self.write_file_task())
 
     @property
@@ -343,12 +374,17 @@ class WSTerminalClient(object):
         request = await self._conn.send_request(
             proto.EnumCommand.SYNC_WORKSPACE,
             workspace=workspace_name,
+            hash_algos=list(workspace.HASH_ALGOS),
         )
         response = await self._conn.read_response(request)
         if response["code"] != 0:
             raise utils.WSTermRuntimeError(response["code"], response["message"])
+        self._workspace.hash_algo = response["hash_algo"]
         utils.write_stdout_inplace("Create workspace diff list")
-        diff_result = self._workspace.make_diff(response["data"])
+        # Walking and hashing the workspace blocks, keep the loop responsive
+        diff_result = await self._loop.run_in_executor(
+            None, self._workspace.make_diff, response["data"]
+        )
         if diff_result:
             await self.update_workspace(diff_result, "")
         utils.write_stdout_inplace("\n")
@@ -463,7 +499,7 @@ class WSTerminalClient(object):
             self._download_file["name"] = buffer[10:pos].decode()
             pos2 = buffer.find(b" ", pos)
             self._download_file["size"] = int(buffer[pos + 1 : pos2])
-            self._download_file["buffer"] = b""
+            self._download_file["buffer"] = bytearray()
             self._download_file["mode"] = "zmodem"
             sys.stdout.buffer.write(
                 b"Transferring %s...\r\n" % self._download_file["name"].encode()
@@ -501,7 +537,7 @@ class WSTerminalClient(object):
                         : pos - len(buffer)
                     ]
                 offset = 0
-                buffer = b""
+                chunks = []
                 while offset < len(self._download_file["buffer"]):
                     pos = self._download_file["buffer"].find(b"\x18i", offset)
                     if pos > 0:
@@ -509,7 +545,7 @@ class WSTerminalClient(object):
                     else:
                         buff = self._download_file["buffer"][offset:]
 
-                    buffer += buff
+                    chunks.append(buff)
                     offset += len(buff)
                     offset += 2  # \x18i
                     index = 0
@@ -523,6 +559,7 @@ class WSTerminalClient(object):
                             index += 1
                     offset += 2
 
+                buffer = b"".join(chunks)
                 mapping_table = {
                     b"\x18\x4d": b"\x0d",
                     b"\x18\x50": b"\x10",
@@ -597,6 +634,13 @@ class WSTerminalClient(object):
                 self._shell_stdout_buffer = bytearray()
                 break
 
+        if not self._flush_pending:
+            # Flush once per event loop iteration for bursts of output
+            self._flush_pending = True
+            self._loop.call_soon(self._flush_stdout)
+
+    def _flush_stdout(self):
+        self._flush_pending = False
         sys.stdout.flush()
 
     def on_shell_exit(self):
@@ -651,6 +695,15 @@ class WSTerminalClient(object):
             with utils.UnixStdIn() as shell_stdin:
 
                 def on_input():
+                    if not line_editor:
+                        # Forward everything available at once, so a paste is
+                        # sent as one request instead of one per byte. Escape
+                        # sequences arrive within a single read.
+                        buffer = shell_stdin.read(4096)
+                        buffer = buffer.replace(b"\n", b"\r")
+                        utils.safe_ensure_future(self.write_shell_stdin(buffer))
+                        return
+
                     char = shell_stdin.read(1)
                     if char == b"\x03":
                         asyncio.ensure_future(self.write_shell_stdin(char))
@@ -658,31 +711,24 @@ class WSTerminalClient(object):
                     elif char == b"\x1b":
                         char += shell_stdin.read(2)
 
-                    if line_editor:
-                        line = line_editor.input(char)
-                        if line:
-                            asyncio.ensure_future(self.write_shell_stdin(line))
-                    else:
-                        if char == b"\n":
-                            char = b"\r"
-                        if server_platform == "win32":
-                            if char == b"\x1b":
-                                chars = shell_stdin.read(2)
-                                char += chars  # Must send together
-
-                        utils.safe_ensure_future(self.write_shell_stdin(char))
+                    line = line_editor.input(char)
+                    if line:
+                        asyncio.ensure_future(self.write_shell_stdin(line))
 
                 self._loop.add_reader(shell_stdin, on_input)
 
+                # Input is read by the reader callback, only poll window size
                 while self._running:
                     size = await self.adjust_window_size(size)
-                    await asyncio.sleep(0.005)
+                    await asyncio.sleep(self.max_poll_interval)
                 self._loop.remove_reader(shell_stdin)
         else:
             import msvcrt
 
+            idle_ticks = 0
             while self._running:
                 if msvcrt.kbhit():
+                    idle_ticks = 0
                     char = msvcrt.getch()
 
                     if char == b"\xe0":
@@ -718,4 +764,11 @@ class WSTerminalClient(object):
                         asyncio.ensure_future(self.write_shell_stdin(char))
                 else:
                     size = await self.adjust_window_size(size)
-                    await asyncio.sleep(0.02)
+                    # Poll fast while typing, back off when idle
+                    await asyncio.sleep(
+                        min(
+                            self.max_poll_interval,
+                            self.min_poll_interval * (1 + idle_ticks),
+                        )
+                    )
+                    idle_ticks += 1
@@ -7,6 +7,8 @@ import struct
 
 import msgpack
 
+_SIZE_STRUCT = struct.Struct("!I")
+
 
 class EnumPacketType(object):
     REQUEST = 1
@@ -14,33 +16,54 @@ class EnumPacketType(object):
 
 
 class EnumCommand(object):
-    SYNC_WORKSPACE = "sync-workspace"
-    LIST_DIR = "list-dir"
-    CREATE_DIR = "create-dir"
-    REMOVE_DIR = "remove-dir"
-    WRITE_FILE = "write-file"
-    REMOVE_FILE = "remove-file"
-    MOVE_ITEM = "move-item"
-    SET_PERM = "set-perm"
-
-    CREATE_SHELL = "create-shell"
-    WRITE_STDIN = "write-stdin"
-    WRITE_STDOUT = "write-stdout"
-    WRITE_STDERR = "write-stderr"
-    RESIZE_SHELL = "resize-shell"
-    EXIT_SHELL = "exit-shell"
+    SYNC_WORKSPACE = 1
+    LIST_DIR = 2
+    CREATE_DIR = 3
+    REMOVE_DIR = 4
+    WRITE_FILE = 5
+    REMOVE_FILE = 6
+    MOVE_ITEM = 7
+    SET_PERM = 8
+
+    CREATE_SHELL = 11
+    WRITE_STDIN = 12
+    WRITE_STDOUT = 13
+    WRITE_STDERR = 14
+    RESIZE_SHELL = 15
+    EXIT_SHELL = 16
+
+
+_NAMES = {
+    value: key.lower().replace("_", "-")
+    for key, value in vars(EnumCommand).items()
+    if not key.startswith("_")
+}
+
+
+# Requests which carry a single ``buffer`` field and are framed as
+# ``[command][buffer]`` without msgpack. Command values are below 0x80,
+# so the first byte never collides with a msgpack map header.
+RAW_COMMANDS = frozenset((EnumCommand.WRITE_STDOUT, EnumCommand.WRITE_STDERR))
+
+_RAW_HEADERS = {command: bytes((command,)) for command in RAW_COMMANDS}
+
+
+def get_command_name(command):
+    return _NAMES.get(command, str(command))
 
 
 class TransportPacket(object):
     """Transport packet serialize/deserialize"""
 
+    __slots__ = ("_message",)
+
     def __init__(self, message):
         self._message = message
 
     def __str__(self):
         return "<%s object command=%s type=%d at 0x%x>" % (
             self.__class__.__name__,
-            self._message.get("command"),
+            get_command_name(self._message.get("command")),
             self._message.get("type"),
             id(self),
         )
@@ -50,16 +73,121 @@ class TransportPacket(object):
         return self._message
 
     def serialize(self):
-        buffer = msgpack.dumps(self._message)
-        return struct.pack("!I", len(buffer)) + buffer
+        buffer = msgpack.packb(self._message)
+        return _SIZE_STRUCT.pack(len(buffer)) + buffer
 
     @staticmethod
     def deserialize(buffer):
-        if len(buffer) < 4:
-            return None, buffer
-        buffer_size = struct.unpack("!I", buffer[:4])[0]
-        if len(buffer) - 4 < buffer_size:
-            return None, buffer
-        message = msgpack.loads(buffer[4 : 4 + buffer_size])
-        buffer = buffer[4 + buffer_size :]
-        return TransportPacket(message), buffer
+        packet, offset = TransportPacket.deserialize_from(buffer)
+        if packet:
+            buffer = buffer[offset:]
+        return packet, buffer
+
+    @staticmethod
+    def deserialize_from(buffer, offset=0):
+        """Deserialize a packet from buffer at offset without slicing the tail
+
+        Returns the packet (or None if incomplete) and the new offset.
+        """
+        if len(buffer) - offset < 4:
+            return None, offset
+        buffer_size = _SIZE_STRUCT.unpack_from(buffer, offset)[0]
+        start = offset + 4
+        end = start + buffer_size
+        if len(buffer) < end:
+            return None, offset
+        with memoryview(buffer) as view:
+            if buffer_size and buffer[start] < 0x80:
+                message = {
+                    "command": buffer[start],
+                    "type": EnumPacketType.REQUEST,
+                    "buffer": bytes(view[start + 1 : end]),
+                }
+            else:
+                message = msgpack.unpackb(view[start:end])
+        return TransportPacket(message), end
+
+
+class PacketReader(object):
+    """Accumulate received data and read packets from it
+
+    When no partial packet is pending, the received data is used in place,
+    so a message holding whole packets is never copied.
+    """
+
+    compact_size = 64 * 1024
+
+    def __init__(self):
+        self._buffer = b""
+        self._offset = 0
+
+    def feed(self, data):
+        if self._offset == len(self._buffer):
+            self._buffer = data
+            self._offset = 0
+            return
+        if not isinstance(self._buffer, bytearray):
+            # Copy the pending partial packet only
+            self._buffer = bytearray(memoryview(self._buffer)[self._offset :])
+            self._offset = 0
+        self._buffer.extend(data)
+
+    def read_packet(self):
+        packet, self._offset = TransportPacket.deserialize_from(
+            self._buffer, self._offset
+        )
+        if self._offset == len(self._buffer):
+            self._buffer = b""
+            self._offset = 0
+        elif self._offset >= self.compact_size and isinstance(
+            self._buffer, bytearray
+        ):
+            del self._buffer[: self._offset]
+            self._offset = 0
+        return packet
+
+
+class RequestPacker(object):
+    """Request serializer caching the constant envelope of each command"""
+
+    def __init__(self):
+        self._packer = msgpack.Packer()
+        self._prefix_map = {}
+
+    def _get_prefix(self, command):
+        prefix = self._prefix_map.get(command)
+        if prefix is None:
+            pack = self._packer.pack
+            prefix = (
+                pack("command")
+                + pack(command)
+                + pack("type")
+                + pack(EnumPacketType.REQUEST)
+                + pack("id")
+            )
+            self._prefix_map[command] = prefix
+        return prefix
+
+    def pack_raw(self, command, chunks):
+        """Pack a raw framed request whose buffer is the join of chunks"""
+        items = [None, _RAW_HEADERS[command]]
+        items.extend(chunks)
+        items[0] = _SIZE_STRUCT.pack(sum(len(it) for it in items[1:]))
+        return b"".join(items)
+
+    def pack(self, command, sequence, **kwargs):
+        if command in RAW_COMMANDS and len(kwargs) == 1 and "buffer" in kwargs:
+            return self.pack_raw(command, (kwargs["buffer"],))
+        pack = self._packer.pack
+        items = [
+            None,  # Placeholder of packet size
+            self._packer.pack_map_header(3 + len(kwargs)),
+            self._get_prefix(command),
+            pack(sequence),
+        ]
+        for key in kwargs:
+            items.append(pack(key))
+            items.append(pack(kwargs[key]))
+        items[0] = _SIZE_STRUCT.pack(sum(len(it) for it in items[1:]))
+        # Join all parts once, the payload is only copied a single time
+        return b"".join(items)
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import collections
 import ctypes
+import functools
+import heapq
+import itertools
+import logging
 import os
 import sys
 import time
@@ -12,39 +17,93 @@ import tornado.websocket
 
 from . import proto, shell, utils, workspace
 
+WORKSPACE_ROOT = (
+    os.environ.get("WSTERM_WORKSPACE") or os.environ.get("TEMP") or "/tmp"
+)
+
+
+class ShellSession(object):
+    __slots__ = ("timeout", "shell", "last_active")
+
+    def __init__(self, timeout, shell, last_active=0):
+        self.timeout = timeout
+        self.shell = shell
+        self.last_active = last_active  # 0 when client connected
+
 
 @utils.Singleton
 class ShellSessionManager(object):
-    def __init__(self):
+    def __init__(self, clock=time.time):
+        self._clock = clock  # Returns the time session times are based on
         self._sessions = {}
-        asyncio.ensure_future(self.check_session_task())
+        self._expiry_heap = []  # (expiry time, session id)
+        self._wakeup_event = asyncio.Event()
+        self._check_task = asyncio.ensure_future(self.check_session_task())
+
+    def close(self):
+        self._check_task.cancel()
+
+    def clean_expired_sessions(self):
+        """Clean sessions expired by now, returns when the next one expires"""
+        now = self._clock()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, session_id = heapq.heappop(self._expiry_heap)
+            session = self._sessions.get(session_id)
+            if not session:
+                continue
+            last_active = session.last_active
+            if last_active and now >= last_active + session.timeout:
+                # Clean session
+                session.shell.exit()
+                self._sessions.pop(session_id)
+        if self._expiry_heap:
+            return self._expiry_heap[0][0]
+        return None
 
     async def check_session_task(self):
         while True:
-            for session in self._sessions:
-                timeout, shell, timestamp = self._sessions[session]
-                if timestamp and time.time() >= timestamp + timeout:
-                    # Clean session
-                    shell.exit()
-                    self._sessions.pop(session)
-                    break
-            await asyncio.sleep(1)
+            next_expiry = self.clean_expired_sessions()
+            # Sleep until next session expired or new session time updated
+            timeout = None
+            if next_expiry is not None:
+                timeout = max(next_expiry - self._clock(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup_event.clear()
 
     def create_session(self, shell, timeout):
         session_id = str(uuid.uuid4())
-        self._sessions[session_id] = [timeout, shell, 0]
+        self._sessions[session_id] = ShellSession(timeout, shell)
         return session_id
 
     def get_session(self, session_id):
         session = self._sessions.get(session_id)
         if session:
-            return session[1]
+            return session.shell
         return None
 
     def update_session_time(self, session_id, timestamp):
         session = self._sessions.get(session_id)
         assert session != None
-        session[2] = timestamp
+        session.last_active = timestamp
+        if timestamp:
+            heapq.heappush(
+                self._expiry_heap, (timestamp + session.timeout, session_id)
+            )
+            self._wakeup_event.set()
+
+
+def requires_workspace(func):
+    """Ignore request if workspace is not synchronized"""
+
+    @functools.wraps(func)
+    async def wrapper(self, request):
+        if self._workspace:
+            await func(self, request)
+
+    return wrapper
 
 
 class WebSocketProtocol(tornado.websocket.WebSocketProtocol13):
@@ -62,14 +121,26 @@ class WSTerminalServerHandler(tornado.websocket.WebSocketHandler):
 
     token = None
     idle_status_mgr = None
+    max_stdout_merge_size = 64 * 1024
+    shell_read_size = 64 * 1024
+    max_pending_write_size = 1024 * 1024
 
     def __init__(self, *args, **kwargs):
         super(WSTerminalServerHandler, self).__init__(*args, **kwargs)
-        self._buffer = b""
+        self._reader = proto.PacketReader()
         self._workspace = None
         self._shell = None
         self._session_id = None
-        self._sequence = 0x10000
+        self._sequence = itertools.count(0x10001)
+        self._request_packer = proto.RequestPacker()
+        self._stdout_queue = collections.deque()
+        self._stdout_event = asyncio.Event()
+        self._stdout_queue_size = 0
+        self._stdout_drained = asyncio.Event()
+        self._stdout_drained.set()
+        self._pending_write_size = 0
+        self._shell_ready = asyncio.Event()
+        self._forward_task = None
 
     def check_permission(self):
         if self.token:
@@ -97,9 +168,11 @@ class WSTerminalServerHandler(tornado.websocket.WebSocketHandler):
             self.__class__.idle_status_mgr.on_new_connection(self)
 
     async def on_message(self, message):
-        self._buffer += message
-        packet, self._buffer = proto.TransportPacket.deserialize(self._buffer)
-        if packet:
+        self._reader.feed(message)
+        while True:
+            packet = self._reader.read_packet()
+            if not packet:
+                break
             try:
                 await self.handle_request(packet.message)
             except Exception as ex:
@@ -107,15 +180,28 @@ class WSTerminalServerHandler(tornado.websocket.WebSocketHandler):
                 await self.send_response(packet.message, -1, str(ex))
 
     async def send_request(self, command, **kwargs):
-        self._sequence += 1
-        data = {
-            "command": command,
-            "type": proto.EnumPacketType.REQUEST,
-            "id": self._sequence,
-        }
-        data.update(kwargs)
-        packet = proto.TransportPacket(data)
-        return await self.write_message(packet.serialize(), True)
+        buffer = self._request_packer.pack(command, next(self._sequence), **kwargs)
+        return await self.write_message(buffer, True)
+
+    async def send_raw_request(self, command, chunks):
+        """Send chunks as the buffer of a raw framed request, joined only once
+
+        Only wait for the data flushed when too much data is not written yet.
+        """
+        buffer = self._request_packer.pack_raw(command, chunks)
+        future = self.write_message(buffer, True)
+        if self._pending_write_size + len(buffer) > self.max_pending_write_size:
+            await future
+            return
+        self._pending_write_size += len(buffer)
+
+        def on_written(future):
+            self._pending_write_size -= len(buffer)
+            if not future.cancelled():
+                # Connection closed error will be raised on next write
+                future.exception()
+
+        future.add_done_callback(on_written)
 
     async def send_response(self, request, code=0, message=None, **kwargs):
         data = {
@@ -129,148 +215,246 @@ class WSTerminalServerHandler(tornado.websocket.WebSocketHandler):
         packet = proto.TransportPacket(data)
         return await self.write_message(packet.serialize(), True)
 
+    async def run_in_executor(self, func, *args):
+        """Run blocking file system operation out of the event loop
+
+        Requests of a connection are handled one by one, so operations on
+        the workspace keep their order.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
     async def handle_request(self, request):
-        utils.logger.debug(
-            "[%s][Request][%d][%s] %s"
-            % (
-                self.__class__.__name__,
-                request.get("id", 0),
-                request.get("command"),
-                str(request)[:200],
-            )
-        )
-        if request["command"] == proto.EnumCommand.SYNC_WORKSPACE:
-            worksapce_id = request["workspace"]
-            workspace_path = os.path.join(
-                os.environ.get("WSTERM_WORKSPACE", os.environ.get("TEMP", "/tmp")),
-                worksapce_id,
+        if utils.logger.isEnabledFor(logging.DEBUG):
+            utils.logger.debug(
+                "[%s][Request][%d][%s] %s"
+                % (
+                    self.__class__.__name__,
+                    request.get("id", 0),
+                    proto.get_command_name(request.get("command")),
+                    str(request)[:200],
+                )
             )
-            self._workspace = workspace.Workspace(workspace_path)
-            data = self._workspace.snapshot()
+        handler = self._request_handlers.get(request["command"])
+        if not handler:
             await self.send_response(
-                request, data=data,
+                request,
+                code=-1,
+                message="Unknown command %s"
+                % proto.get_command_name(request["command"]),
             )
-        elif self._workspace and request["command"] == proto.EnumCommand.WRITE_FILE:
-            utils.logger.info(
-                "[%s] Update file %s" % (self.__class__.__name__, request["path"])
-            )
-            self._workspace.write_file(
-                request["path"], request["data"], request["overwrite"]
-            )
-        elif self._workspace and request["command"] == proto.EnumCommand.REMOVE_FILE:
-            utils.logger.info(
-                "[%s] Remove file %s" % (self.__class__.__name__, request["path"])
+            return
+        await handler(self, request)
+
+    async def _handle_sync_workspace(self, request):
+        workspace_id = request["workspace"]
+        if workspace_id in ("", ".", "..") or (
+            os.path.basename(workspace_id) != workspace_id
+        ):
+            await self.send_response(
+                request, code=-1, message="Invalid workspace %s" % workspace_id
             )
-            self._workspace.remove_file(request["path"])
-        elif self._workspace and request["command"] == proto.EnumCommand.CREATE_DIR:
+            return
+        workspace_path = os.path.join(WORKSPACE_ROOT, workspace_id)
+        # Prefer the first algorithm of the client which is supported here
+        hash_algo = workspace.HASH_ALGO_MD5
+        for it in request["hash_algos"]:
+            if it in workspace.HASH_ALGOS:
+                hash_algo = it
+                break
+        self._workspace = workspace.Workspace(workspace_path, hash_algo=hash_algo)
+        data = await self.run_in_executor(self._workspace.snapshot)
+        await self.send_response(
+            request, data=data, hash_algo=hash_algo,
+        )
+
+    @requires_workspace
+    async def _handle_write_file(self, request):
+        utils.logger.info(
+            "[%s] Update file %s" % (self.__class__.__name__, request["path"])
+        )
+        await self.run_in_executor(
+            self._workspace.write_file,
+            request["path"],
+            request["data"],
+            request["overwrite"],
+        )
+
+    @requires_workspace
+    async def _handle_remove_file(self, request):
+        utils.logger.info(
+            "[%s] Remove file %s" % (self.__class__.__name__, request["path"])
+        )
+        await self.run_in_executor(self._workspace.remove_file, request["path"])
+
+    @requires_workspace
+    async def _handle_create_dir(self, request):
+        utils.logger.info(
+            "[%s] Create directory %s" % (self.__class__.__name__, request["path"])
+        )
+        await self.run_in_executor(self._workspace.create_directory, request["path"])
+
+    @requires_workspace
+    async def _handle_remove_dir(self, request):
+        utils.logger.info(
+            "[%s] Remove directory %s" % (self.__class__.__name__, request["path"])
+        )
+        await self.run_in_executor(self._workspace.remove_directory, request["path"])
+
+    @requires_workspace
+    async def _handle_move_item(self, request):
+        utils.logger.info(
+            "[%s] Move item %s to %s"
+            % (self.__class__.__name__, request["src_path"], request["dst_path"])
+        )
+        await self.run_in_executor(
+            self._workspace.move_item, request["src_path"], request["dst_path"]
+        )
+
+    @requires_workspace
+    async def _handle_set_perm(self, request):
+        utils.logger.info(
+            "[%s] Set item %s permission %s"
+            % (self.__class__.__name__, request["path"], request["perm"])
+        )
+        await self.run_in_executor(
+            self._workspace.set_perm, request["path"], request["perm"]
+        )
+
+    async def _handle_create_shell(self, request):
+        session_id = request.get("session")
+        session_timeout = request.get("timeout")
+        utils.logger.info(
+            "[%s] Create shell (%d, %d)" % (self.__class__.__name__, *request["size"])
+        )
+
+        ssm = ShellSessionManager()
+        if self._shell:
+            await self.send_response(request, code=-1, message="Shell is created")
+        elif session_id:
+            shell = ssm.get_session(session_id)
+            if not shell:
+                await self.send_response(
+                    request,
+                    code=-1,
+                    message="Shell session %s not found" % session_id,
+                )
+                return
             utils.logger.info(
-                "[%s] Create directory %s" % (self.__class__.__name__, request["path"])
+                "[%s] Use Cached shell session %s"
+                % (self.__class__.__name__, session_id)
             )
-            self._workspace.create_directory(request["path"])
-        elif self._workspace and request["command"] == proto.EnumCommand.REMOVE_DIR:
-            utils.logger.info(
-                "[%s] Remove directory %s" % (self.__class__.__name__, request["path"])
+            self._session_id = session_id
+            self._shell = shell
+            ssm.update_session_time(session_id, 0)  # Avoid cleaned
+            self._forward_task = asyncio.ensure_future(self.forward_shell())
+            await self.send_response(request, platform=sys.platform)
+        else:
+            shell_workspace = os.getcwd()
+            if self._workspace:
+                shell_workspace = self._workspace.path
+            asyncio.ensure_future(self.spawn_shell(shell_workspace, request["size"]))
+            try:
+                await asyncio.wait_for(self._shell_ready.wait(), 5)
+            except asyncio.TimeoutError:
+                await self.send_response(
+                    request, code=-1, message="Spawn shell timeout"
+                )
+                return
+
+            line_mode = sys.platform == "win32" and not hasattr(
+                ctypes.windll.kernel32, "CreatePseudoConsole"
             )
-            self._workspace.remove_directory(request["path"])
-        elif self._workspace and request["command"] == proto.EnumCommand.MOVE_ITEM:
-            utils.logger.info(
-                "[%s] Move item %s to %s"
-                % (self.__class__.__name__, request["src_path"], request["dst_path"])
+            if session_timeout:
+                self._session_id = ssm.create_session(self._shell, session_timeout)
+                await self.send_response(
+                    request,
+                    platform=sys.platform,
+                    session=self._session_id,
+                    line_mode=line_mode,
+                )
+            else:
+                await self.send_response(
+                    request, platform=sys.platform, line_mode=line_mode
+                )
+
+    async def _handle_write_stdin(self, request):
+        if not self._shell:
+            await self.send_response(request, code=-1, message="Shell not create")
+        else:
+            utils.logger.debug(
+                "[%s] Input %s", self.__class__.__name__, request["buffer"]
             )
-            self._workspace.move_item(request["src_path"], request["dst_path"])
-        elif self._workspace and request["command"] == proto.EnumCommand.SET_PERM:
+            self._shell.write(request["buffer"])
+
+    async def _handle_resize_shell(self, request):
+        if not self._shell:
+            await self.send_response(request, code=-1, message="Shell not create")
+        else:
             utils.logger.info(
-                "[%s] Set item %s permission %s"
-                % (self.__class__.__name__, request["path"], request["perm"])
+                "[%s] Resize shell to %d,%d"
+                % (self.__class__.__name__, request["size"][0], request["size"][1])
             )
-            self._workspace.set_perm(request["path"], request["perm"])
-        elif request["command"] == proto.EnumCommand.CREATE_SHELL:
-            session_id = request.get("session")
-            session_timeout = request.get("timeout")
+            self._shell.resize(request["size"])
+            await self.send_response(request)
+
+    _request_handlers = {
+        proto.EnumCommand.SYNC_WORKSPACE: _handle_sync_workspace,
+        proto.EnumCommand.WRITE_FILE: _handle_write_file,
+        proto.EnumCommand.REMOVE_FILE: _handle_remove_file,
+        proto.EnumCommand.CREATE_DIR: _handle_create_dir,
+        proto.EnumCommand.REMOVE_DIR: _handle_remove_dir,
+        proto.EnumCommand.MOVE_ITEM: _handle_move_item,
+        proto.EnumCommand.SET_PERM: _handle_set_perm,
+        proto.EnumCommand.CREATE_SHELL: _handle_create_shell,
+        proto.EnumCommand.WRITE_STDIN: _handle_write_stdin,
+        proto.EnumCommand.RESIZE_SHELL: _handle_resize_shell,
+    }
+
+    async def write_shell_stdout(self, buffer):
+        utils.logger.debug("[%s] Output %s", self.__class__.__name__, buffer)
+        self._stdout_queue.append(buffer)
+        self._stdout_queue_size += len(buffer)
+        self._stdout_event.set()
+        if self._stdout_queue_size > self.max_pending_write_size:
+            # Stop reading shell output until the writer catches up
+            self._stdout_drained.clear()
+            await self._stdout_drained.wait()
+
+    async def write_shell_stdout_task(self):
+        """Merge pending shell output into as few packets as possible"""
+        try:
+            await self._write_shell_stdout_loop()
+        except tornado.websocket.WebSocketClosedError:
             utils.logger.info(
-                "[%s] Create shell (%d, %d)"
-                % (self.__class__.__name__, *request["size"])
+                "[%s] Connection closed, drop pending shell output"
+                % self.__class__.__name__
             )
-
-            ssm = ShellSessionManager()
-            if self._shell:
-                await self.send_response(request, code=-1, message="Shell is created")
-            else:
-                if session_id:
-                    shell = ssm.get_session(session_id)
-                    if not shell:
-                        await self.send_response(
-                            request,
-                            code=-1,
-                            message="Shell session %s not found" % session_id,
-                        )
+            self._stdout_queue.clear()
+            self._stdout_queue_size = 0
+            self._stdout_drained.set()
+
+    async def _write_shell_stdout_loop(self):
+        while self.ws_connection:
+            await self._stdout_event.wait()
+            self._stdout_event.clear()
+            while self._stdout_queue:
+                chunks = []
+                size = 0
+                while self._stdout_queue and size < self.max_stdout_merge_size:
+                    buffer = self._stdout_queue.popleft()
+                    if buffer is None:
+                        # Shell exited
+                        if chunks:
+                            await self.send_raw_request(
+                                proto.EnumCommand.WRITE_STDOUT, chunks
+                            )
                         return
-                    utils.logger.info(
-                        "[%s] Use Cached shell session %s"
-                        % (self.__class__.__name__, session_id)
-                    )
-                    self._session_id = session_id
-                    self._shell = shell
-                    ssm.update_session_time(session_id, 0)  # Avoid cleaned
-                    asyncio.ensure_future(self.forward_shell())
-                    await self.send_response(request, platform=sys.platform)
-                else:
-                    shell_workspace = os.getcwd()
-                    if self._workspace:
-                        shell_workspace = self._workspace.path
-                    asyncio.ensure_future(
-                        self.spawn_shell(shell_workspace, request["size"])
-                    )
-                    time0 = time.time()
-                    while time.time() - time0 < 5:
-                        if self._shell:
-                            break
-                        await asyncio.sleep(0.005)
-                    else:
-                        await self.send_response(
-                            request, code=-1, message="Spawn shell timeout"
-                        )
-                        return
-
-                    line_mode = sys.platform == "win32" and not hasattr(
-                        ctypes.windll.kernel32, "CreatePseudoConsole"
-                    )
-                    if session_timeout:
-                        self._session_id = ssm.create_session(
-                            self._shell, session_timeout
-                        )
-                        await self.send_response(
-                            request,
-                            platform=sys.platform,
-                            session=self._session_id,
-                            line_mode=line_mode,
-                        )
-                    else:
-                        await self.send_response(
-                            request, platform=sys.platform, line_mode=line_mode
-                        )
-        elif request["command"] == proto.EnumCommand.WRITE_STDIN:
-            if not self._shell:
-                await self.send_response(request, code=-1, message="Shell not create")
-            else:
-                utils.logger.debug(
-                    "[%s] Input %s" % (self.__class__.__name__, request["buffer"])
-                )
-                self._shell.write(request["buffer"])
-        elif request["command"] == proto.EnumCommand.RESIZE_SHELL:
-            if not self._shell:
-                await self.send_response(request, code=-1, message="Shell not create")
-            else:
-                utils.logger.info(
-                    "[%s] Resize shell to %d,%d"
-                    % (self.__class__.__name__, request["size"][0], request["size"][1])
-                )
-                self._shell.resize(request["size"])
-                await self.send_response(request)
-
-    async def write_shell_stdout(self, buffer):
-        utils.logger.debug("[%s] Output %s" % (self.__class__.__name__, buffer))
-        await self.send_request(proto.EnumCommand.WRITE_STDOUT, buffer=buffer)
+                    chunks.append(buffer)
+                    size += len(buffer)
+                self._stdout_queue_size -= size
+                await self.send_raw_request(proto.EnumCommand.WRITE_STDOUT, chunks)
+                if self._stdout_queue_size <= self.max_pending_write_size // 2:
+                    self._stdout_drained.set()
 
     async def spawn_shell(self, workspace, size):
         utils.logger.info(
@@ -278,55 +462,70 @@ class WSTerminalServerHandler(tornado.websocket.WebSocketHandler):
             % (self.__class__.__name__, size[0], size[1])
         )
         self._shell = await shell.Shell.create(workspace, size)
-        await self.forward_shell()
+        self._shell_ready.set()
+        self._forward_task = asyncio.ensure_future(self.forward_shell())
 
     async def forward_shell(self):
-        tasks = [None]
-        if self._shell.stderr:
-            tasks.append(None)
-
-        while self._shell and self._shell.process.returncode is None:
-            if tasks[0] is None:
-                tasks[0] = utils.safe_ensure_future(self._shell.stdout.read(4096))
-            if self._shell.stderr and tasks[1] is None:
-                tasks[1] = utils.safe_ensure_future(self._shell.stderr.read(4096))
-
-            done_tasks, _ = await asyncio.wait(
-                tasks, return_when=asyncio.FIRST_COMPLETED
-            )
-
-            for task in done_tasks:
-                index = tasks.index(task)
-                assert index >= 0
-                tasks[index] = None
-                buffer = task.result()
-                if not buffer:
-                    await asyncio.sleep(0.01)
-                    break
-
-                if self._shell:
-                    if sys.platform == "win32":
-                        try:
-                            buffer.decode("utf-8")
-                        except UnicodeDecodeError:
-                            try:
-                                buffer = buffer.decode("gbk").encode("utf-8")  # TODO: fixme
-                            except UnicodeDecodeError:
-                                utils.logger.warn(
-                                    "[%s] Decode buffer %r failed"
-                                    % (self.__class__.__name__, buffer)
-                                )
-                    await self.write_shell_stdout(buffer)
-        utils.logger.warn("[%s] Shell process exit" % self.__class__.__name__)
+        writer_task = asyncio.ensure_future(self.write_shell_stdout_task())
+        try:
+            process = self._shell.process
+            if self._shell.stderr:
+                # One reader per stream for the whole session, rather than
+                # a new read task for every chunk
+                await asyncio.gather(
+                    self._forward_shell_stream(self._shell.stdout, process),
+                    self._forward_shell_stream(self._shell.stderr, process),
+                )
+            else:
+                await self._forward_shell_stream(self._shell.stdout, process)
+            if self._shell and process.returncode is None:
+                # All streams closed, wait for process exit
+                await process.wait()
+            utils.logger.warn("[%s] Shell process exit" % self.__class__.__name__)
+            # Wait for pending output sent
+            self._stdout_queue.append(None)
+            self._stdout_event.set()
+            await writer_task
+        finally:
+            writer_task.cancel()
         if self._shell:
             await self.send_request(proto.EnumCommand.EXIT_SHELL)
             self._shell = None
 
+    async def _forward_shell_stream(self, stream, process):
+        while self._shell and process.returncode is None:
+            buffer = await stream.read(self.shell_read_size)
+            if not buffer:
+                # EOF
+                break
+            await self._on_shell_output(buffer)
+
+    async def _on_shell_output(self, buffer):
+        if not self._shell:
+            return
+        if sys.platform == "win32" and not buffer.isascii():
+            # Plain ASCII output is valid in both encodings
+            try:
+                buffer.decode("utf-8")
+            except UnicodeDecodeError:
+                try:
+                    buffer = buffer.decode("gbk").encode("utf-8")  # TODO: fixme
+                except UnicodeDecodeError:
+                    utils.logger.warn(
+                        "[%s] Decode buffer %r failed"
+                        % (self.__class__.__name__, buffer)
+                    )
+        await self.write_shell_stdout(buffer)
+
     def on_connection_close(self):
         utils.logger.warn("[%s] Connection closed" % self.__class__.__name__)
         if self.__class__.idle_status_mgr:
             self.__class__.idle_status_mgr.on_connection_closed(self)
 
+        if self._forward_task:
+            # A reconnected handler reads the cached shell from now on
+            self._forward_task.cancel()
+            self._forward_task = None
         if self._shell:
             if not self._session_id:
                 # Do not keep session
@@ -335,6 +534,8 @@ class WSTerminalServerHandler(tornado.websocket.WebSocketHandler):
                 # Wait foe client reconnect
                 ShellSessionManager().update_session_time(self._session_id, time.time())
             self._shell = None
+        self._shell_ready.clear()
+        self._stdout_drained.set()
 
 
 class MainHandler(tornado.web.RequestHandler):
@@ -384,6 +585,21 @@ class IdleStatusManager(object):
 
 
 def start_server(listen_address, path, token=None, idle_timeout=0):
+    if sys.platform != "win32":
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            utils.logger.info("Use uvloop event loop")
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        import tornado.speedups
+    except ImportError:
+        utils.logger.warning(
+            "tornado.speedups not available, websocket masking will be slow"
+        )
+
     utils.logger.info("Websocket server listening at %s:%d" % listen_address)
 
     def on_idle_timeout():
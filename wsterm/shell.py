@@ -2,16 +2,53 @@
 
 import asyncio
 import ctypes
+import functools
 import os
 import shlex
+import shutil
 import struct
 import sys
 
+if sys.platform != "win32":
+    import fcntl
+    import pty
+    import termios
+
 from . import utils
 
+_WINSIZE_STRUCT = struct.Struct("HHHH")
+
+
+@functools.lru_cache(maxsize=4)
+def _resolve_shell(shell, path):
+    cmdline = shlex.split(shell)
+    exe = cmdline[0]
+    if exe[0] != "/":
+        exe = shutil.which(exe, path=path) or "/bin/sh"
+    return exe, tuple(cmdline)
+
+
+def _spawn_pty(workspace, exe, cmdline):
+    env = dict(os.environ)
+    pid, fd = pty.fork()
+    if pid == 0:
+        # Child process forked from a worker thread while other threads may
+        # hold the stdio locks, so never touch sys.stdout/sys.stderr here
+        try:
+            os.chdir(workspace)
+            os.execve(exe, cmdline, env)
+        except BaseException as e:
+            os.write(2, ("%s\n" % e).encode())
+        finally:
+            os._exit(1)
+    return pid, fd
+
 
 class Shell(object):
+    max_burst_writes = 4
+
     def __init__(self, workspace, size, proc, stdin, stdout, stderr, fd):
+        self._loop = asyncio.get_running_loop()
         self._workspace = workspace
         self._size = None
         self._proc = proc
@@ -19,6 +56,8 @@ class Shell(object):
         self._stdin = stdin
         self._stdout = stdout
         self._stderr = stderr
+        self._pending = bytearray()
+        self._burst_count = 0
         self.resize(size)
 
     @property
@@ -74,60 +113,62 @@ class Shell(object):
                 cwd=workspace,
                 stdin=asyncio.subprocess.PIPE,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
+                # One pipe and one reader for all shell output
+                stderr=asyncio.subprocess.STDOUT,
                 close_fds=False
             )
             stdin = proc.stdin
             stdout = proc.stdout
-            stderr = proc.stderr
+            stderr = None
             fd = None
         else:
-            import pty
-
-            cmdline = list(shlex.split(os.environ.get("SHELL") or "bash"))
-            exe = cmdline[0]
-            if exe[0] != "/":
-                for it in os.environ["PATH"].split(":"):
-                    path = os.path.join(it, exe)
-                    if os.path.isfile(path):
-                        exe = path
-                        break
-                else:
-                    exe = "/bin/sh"
+            exe, cmdline = _resolve_shell(
+                os.environ.get("SHELL") or "bash", os.environ["PATH"]
+            )
 
             utils.logger.info("[%s] Create shell %s" % (cls.__name__, cmdline))
-            pid, fd = pty.fork()
-            if pid == 0:
-                # child process
-                sys.stdout.flush()
-                os.chdir(workspace)
-                try:
-                    os.execve(exe, cmdline, os.environ)
-                except Exception as e:
-                    sys.stderr.write(str(e))
-            else:
-                proc = utils.Process(pid)
-                stdin = utils.AsyncFileDescriptor(fd)
-                stdout = utils.AsyncFileDescriptor(fd)
-                stderr = None
+            # Fork outside of the event loop thread
+            pid, fd = await asyncio.get_running_loop().run_in_executor(
+                None, _spawn_pty, workspace, exe, cmdline
+            )
+            proc = utils.Process(pid)
+            # Only one reader registered on the pty fd
+            stdin = stdout = utils.AsyncFileDescriptor(fd)
+            stderr = None
 
         return cls(workspace, size, proc, stdin, stdout, stderr, fd)
 
     def write(self, buffer):
-        self._stdin.write(buffer)
+        """Write the first few inputs of a loop iteration at once, and merge
+        the rest into one write at the end of the iteration
+        """
+        if not self._pending and self._burst_count < self.max_burst_writes:
+            if not self._burst_count:
+                self._loop.call_soon(self._flush)
+            self._burst_count += 1
+            self._stdin.write(buffer)
+        else:
+            self._pending.extend(buffer)
+
+    def _flush(self):
+        self._burst_count = 0
+        if self._pending:
+            buffer = bytes(self._pending)
+            self._pending.clear()
+            self._stdin.write(buffer)
 
     def resize(self, size):
+        size = tuple(size)
+        if size == self._size:
+            return True
         if sys.platform == "win32":
             pass
         else:
-            import fcntl
-            import termios
-
-            winsize = struct.pack("HHHH", size[1], size[0], 0, 0)
+            winsize = _WINSIZE_STRUCT.pack(size[1], size[0], 0, 0)
             fcntl.ioctl(self._fd, termios.TIOCSWINSZ, winsize)
         self._size = size
         return True
 
     def exit(self):
-        self._stdin.write(b"exit\n")
+        self.write(b"exit\n")
         utils.logger.info("[%s] Shell exit" % self.__class__.__name__)
@@ -4,15 +4,29 @@
 """
 
 import asyncio
+import collections
 import ctypes
 import hashlib
+import importlib.machinery
+import importlib.util
+import itertools
 import logging
 import os
+import select
 import subprocess
 import sys
 
+if sys.platform != "win32":
+    import termios
+    import tty
+
 logger = logging.getLogger("wsterm")
 
+_CLEAR_LINE = "\r" + " " * 80 + "\r"
+_CLEAR_LINE_ANSI = "\r\x1b[2K"
+# Set by enable_native_ansi on Windows
+_ansi_enabled = sys.platform != "win32"
+
 
 class WSTermRuntimeError(RuntimeError):
     def __init__(self, code, message):
@@ -42,37 +56,95 @@ class ConnectionClosedError(RuntimeError):
 class AsyncFileDescriptor(object):
     """Async File Descriptor"""
 
+    read_size = 64 * 1024
+    max_buffer_size = 1024 * 1024
+
     def __init__(self, fd):
-        self._loop = asyncio.get_event_loop()
+        # Always created from a coroutine, so the running loop is known
+        self._loop = asyncio.get_running_loop()
+        self._add_reader = self._loop.add_reader
+        self._remove_reader = self._loop.remove_reader
         self._fd = fd
         self._event = asyncio.Event()
-        self._buffer = b""
-        self._loop.add_reader(self._fd, self.read_callback)
+        self._chunks = collections.deque()
+        self._buffer_size = 0
+        self._write_buffer = bytearray()
+        os.set_blocking(self._fd, False)
+        self._add_reader(self._fd, self.read_callback)
+        self._paused = False
         self._closed = False
 
     def close(self):
-        self._loop.remove_reader(self._fd)
-
-    async def read(self, bytes=4096):
-        await self._event.wait()
-        self._event.clear()
-        buffer = self._buffer
-        self._buffer = b""
+        self._remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+
+    async def read(self, size=4096):
+        while not self._chunks:
+            # Another reader may have taken the data of this wakeup
+            if self._closed:
+                return b""
+            await self._event.wait()
+            self._event.clear()
+        # Joining a single chunk returns it without a copy
+        buffer = b"".join(self._chunks)
+        self._chunks.clear()
+        self._buffer_size = 0
+        if self._paused and not self._closed:
+            self._add_reader(self._fd, self.read_callback)
+            self._paused = False
         return buffer
 
     def write(self, buffer):
-        os.write(self._fd, buffer)
-
-    def read_callback(self, *args):
+        if self._write_buffer:
+            self._write_buffer.extend(buffer)
+            return
         try:
-            buffer = os.read(self._fd, 4096)
-        except OSError:
-            self.close()
-            self._closed = True
-            self._event.set()
+            written = os.write(self._fd, buffer)
+        except BlockingIOError:
+            written = 0
+        if written < len(buffer):
+            # Wait until the pty accepts more input
+            self._write_buffer.extend(buffer[written:])
+            self._loop.add_writer(self._fd, self.write_callback)
+
+    def write_callback(self, *args):
+        try:
+            written = os.write(self._fd, self._write_buffer)
+        except BlockingIOError:
             return
+        except OSError:
+            written = len(self._write_buffer)
+        del self._write_buffer[:written]
+        if not self._write_buffer:
+            self._loop.remove_writer(self._fd)
+
+    def read_callback(self, *args):
+        # Resolve lookups once per wakeup rather than once per chunk
+        read = os.read
+        fd = self._fd
+        read_size = self.read_size
+        append = self._chunks.append
+        buffer_size = self._buffer_size
+        while True:
+            try:
+                buffer = read(fd, read_size)
+            except BlockingIOError:
+                break
+            except OSError:
+                buffer = b""
 
-        self._buffer += buffer
+            if not buffer:
+                self.close()
+                self._closed = True
+                break
+            append(buffer)
+            buffer_size += len(buffer)
+            if buffer_size >= self.max_buffer_size:
+                # Stop reading until the consumer catches up
+                self._remove_reader(fd)
+                self._paused = True
+                break
+        self._buffer_size = buffer_size
         self._event.set()
 
     def __enter__(self):
@@ -83,23 +155,80 @@ class AsyncFileDescriptor(object):
         self._closed = True
 
 
+def _waitstatus_to_exitcode(status):
+    if hasattr(os, "waitstatus_to_exitcode"):
+        return os.waitstatus_to_exitcode(status)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
 class Process(object):
     def __init__(self, pid):
         self._pid = pid
         self._returncode = None
+        self._exit_event = asyncio.Event()
         safe_ensure_future(self._wait_for_exit())
 
     @property
     def returncode(self):
         return self._returncode
 
+    async def wait(self):
+        await self._exit_event.wait()
+        return self._returncode
+
+    async def _wait_readable(self, fd):
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        loop.add_reader(fd, event.set)
+        try:
+            await event.wait()
+        finally:
+            loop.remove_reader(fd)
+
     async def _wait_for_exit(self):
+        if hasattr(os, "pidfd_open"):
+            try:
+                fd = os.pidfd_open(self._pid)
+            except OSError:
+                # Kernel older than 5.3 or process already reaped
+                pass
+            else:
+                try:
+                    await self._wait_readable(fd)
+                finally:
+                    os.close(fd)
+        elif hasattr(select, "kqueue"):
+            kq = select.kqueue()
+            try:
+                kq.control(
+                    [
+                        select.kevent(
+                            self._pid,
+                            select.KQ_FILTER_PROC,
+                            select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                            select.KQ_NOTE_EXIT,
+                        )
+                    ],
+                    0,
+                )
+            except OSError:
+                # Process already exited
+                pass
+            else:
+                await self._wait_readable(kq.fileno())
+            finally:
+                kq.close()
+
+        # Reap the process, polling only if no exit notification is available
         while True:
             try:
                 pid, returncode = os.waitpid(self._pid, os.WNOHANG)
             except ChildProcessError:
                 logger.warn(
-                    "[%s] Process %d already exited" % (self.__class__.__name__, pid)
+                    "[%s] Process %d already exited"
+                    % (self.__class__.__name__, self._pid)
                 )
                 self._returncode = -1
                 break
@@ -107,26 +236,21 @@ class Process(object):
             if not pid:
                 await asyncio.sleep(0.01)
             else:
-                self._returncode = returncode
+                self._returncode = _waitstatus_to_exitcode(returncode)
                 break
+        self._exit_event.set()
 
 
 class UnixStdIn(object):
     def __init__(self, stdin=None):
         self._fd = stdin or sys.stdin.fileno()
-        import termios
-
         self._settings = termios.tcgetattr(self._fd)
 
     def __enter__(self):
-        import tty
-
         tty.setraw(self._fd)
         return self
 
     def __exit__(self, exc_type, exc_value, exc_trackback):
-        import termios
-
         termios.tcsetattr(self._fd, termios.TCSADRAIN, self._settings)
 
     def fileno(self):
@@ -148,8 +272,14 @@ class Singleton(object):
             self.__instance = self.__cls(*args, **kwargs)
         return self.__instance
 
+    def reset(self):
+        """Drop the instance, the next call creates a new one. For tests."""
+        self.__instance = None
+
 
 class LineEditor(object):
+    bs_key = b"\x08" if sys.platform == "win32" else b"\x1b[D"
+
     def __init__(self):
         self._buffer = b""
         self._prev_buffer = b""
@@ -159,102 +289,136 @@ class LineEditor(object):
         self._history_index = 0
 
     def _clear_buffer(self, size):
-        bs_key = b"\x08" if sys.platform == "win32" else b"\x1b[D"
-        sys.stdout.buffer.write(bs_key * size)
-        sys.stdout.buffer.write(b" " * size)
-        sys.stdout.buffer.write(bs_key * size)
+        return [self.bs_key * size, b" " * size, self.bs_key * size]
 
-    def input(self, char):
-        bs_key = b"\x08" if sys.platform == "win32" else b"\x1b[D"
-        if char in (b"\x1bOD", b"\x1b[D"):
-            if self._cursor > 0:
-                self._cursor -= 1
-        elif char in (b"\x1bOC", b"\x1b[C"):
-            if self._cursor < len(self._buffer):
-                self._cursor += 1
-        elif char in (b"\x1bOA", b"\x1b[A"):
-            if abs(self._history_index) >= len(self._history):
-                return
-            self._history_index -= 1
-            self._clear_buffer(self._prev_cursor)
-            sys.stdout.buffer.write(self._history[self._history_index])
+    def _flush_output(self, parts):
+        if not hasattr(os, "writev"):
+            sys.stdout.buffer.write(b"".join(parts))
             sys.stdout.buffer.flush()
-            self._buffer = self._prev_buffer = self._history[self._history_index]
-            self._cursor = self._prev_cursor = len(self._buffer)
             return
-        elif char in (b"\x1bOB", b"\x1b[B"):
-            if self._history_index >= -1:
-                return
-            self._history_index += 1
-            self._clear_buffer(self._prev_cursor)
-            sys.stdout.buffer.write(self._history[self._history_index])
-            sys.stdout.buffer.flush()
-            self._buffer = self._prev_buffer = self._history[self._history_index]
-            self._cursor = self._prev_cursor = len(self._buffer)
+        # Keep order with output still buffered in sys.stdout
+        sys.stdout.buffer.flush()
+        fd = sys.stdout.fileno()
+        written = os.writev(fd, parts)
+        if written < sum(len(it) for it in parts):
+            rest = memoryview(b"".join(parts))[written:]
+            while rest:
+                rest = rest[os.write(fd, rest) :]
+
+    def _move_left(self):
+        if self._cursor > 0:
+            self._cursor -= 1
+        self._redraw()
+
+    def _move_right(self):
+        if self._cursor < len(self._buffer):
+            self._cursor += 1
+        self._redraw()
+
+    def _show_history(self):
+        parts = self._clear_buffer(self._prev_cursor)
+        parts.append(self._history[self._history_index])
+        self._flush_output(parts)
+        self._buffer = self._prev_buffer = self._history[self._history_index]
+        self._cursor = self._prev_cursor = len(self._buffer)
+
+    def _history_prev(self):
+        if abs(self._history_index) >= len(self._history):
             return
-        elif char in (b"\x08", b"\x7f"):
-            if self._cursor > 0:
-                self._buffer = (
-                    self._buffer[: self._cursor - 1] + self._buffer[self._cursor :]
-                )
-                self._cursor -= 1
-        elif char in (b"\r", b"\n"):
-            if self._buffer:
-                self._history.append(self._buffer)
-                self._history_index = 0
-            buffer = self._buffer + b"\n"
-            self._buffer = b""
-            self._cursor = 0
-            if self._prev_cursor:
-                sys.stdout.buffer.write(bs_key * self._prev_cursor)
-                self._prev_buffer = b""
-                self._prev_cursor = 0
-
-            return buffer
-        elif char == b"\x03":
-            raise KeyboardInterrupt()
-        else:
+        self._history_index -= 1
+        self._show_history()
+
+    def _history_next(self):
+        if self._history_index >= -1:
+            return
+        self._history_index += 1
+        self._show_history()
+
+    def _backspace(self):
+        if self._cursor > 0:
             self._buffer = (
-                self._buffer[: self._cursor] + char + self._buffer[self._cursor :]
+                self._buffer[: self._cursor - 1] + self._buffer[self._cursor :]
             )
-            self._cursor += 1
+            self._cursor -= 1
+        self._redraw()
+
+    def _enter(self):
+        if self._buffer:
+            self._history.append(self._buffer)
+            self._history_index = 0
+        buffer = self._buffer + b"\n"
+        self._buffer = b""
+        self._cursor = 0
+        if self._prev_cursor:
+            sys.stdout.buffer.write(self.bs_key * self._prev_cursor)
+            self._prev_buffer = b""
+            self._prev_cursor = 0
+        return buffer
 
+    def _interrupt(self):
+        raise KeyboardInterrupt()
+
+    def _redraw(self):
+        bs_key = self.bs_key
+        parts = []
         if self._prev_cursor:
-            sys.stdout.buffer.write(bs_key * self._prev_cursor)
+            parts.append(bs_key * self._prev_cursor)
 
-        sys.stdout.buffer.write(self._buffer)
+        parts.append(self._buffer)
         if len(self._buffer) < len(self._prev_buffer):
             # Remove deleted chars
-            sys.stdout.buffer.write(b" " * (len(self._prev_buffer) - len(self._buffer)))
-            sys.stdout.buffer.write(
-                bs_key * (len(self._prev_buffer) - len(self._buffer))
-            )
+            parts.append(b" " * (len(self._prev_buffer) - len(self._buffer)))
+            parts.append(bs_key * (len(self._prev_buffer) - len(self._buffer)))
 
         if self._cursor < len(self._buffer):
-            sys.stdout.buffer.write(bs_key * (len(self._buffer) - self._cursor))
-        sys.stdout.buffer.flush()
+            parts.append(bs_key * (len(self._buffer) - self._cursor))
+        self._flush_output(parts)
         self._prev_buffer = self._buffer
         self._prev_cursor = self._cursor
 
+    def input(self, char):
+        handler = self._key_handlers.get(char)
+        if handler:
+            return handler(self)
+        self._buffer = (
+            self._buffer[: self._cursor] + char + self._buffer[self._cursor :]
+        )
+        self._cursor += 1
+        self._redraw()
+
+    _key_handlers = {
+        b"\x1bOD": _move_left,
+        b"\x1b[D": _move_left,
+        b"\x1bOC": _move_right,
+        b"\x1b[C": _move_right,
+        b"\x1bOA": _history_prev,
+        b"\x1b[A": _history_prev,
+        b"\x1bOB": _history_next,
+        b"\x1b[B": _history_next,
+        b"\x08": _backspace,
+        b"\x7f": _backspace,
+        b"\r": _enter,
+        b"\n": _enter,
+        b"\x03": _interrupt,
+    }
+
+
+def _log_task_exception(task):
+    if not task.cancelled() and task.exception():
+        logger.error("Task %r failed", task, exc_info=task.exception())
 
-def safe_ensure_future(coro, loop=None):
-    loop = loop or asyncio.get_event_loop()
-    fut = loop.create_future()
-
-    async def _wrap():
-        try:
-            fut.set_result(await coro)
-        except Exception as e:
-            fut.set_exception(e)
 
-    asyncio.ensure_future(_wrap())
-    return fut
+def safe_ensure_future(coro, loop=None):
+    task = asyncio.ensure_future(coro, loop=loop)
+    task.add_done_callback(_log_task_exception)
+    return task
 
 
 def enable_native_ansi():
     """Enables native ANSI sequences in console. Windows 10 only.
     Returns whether successful.
     """
+    global _ansi_enabled
     import ctypes.wintypes
 
     ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x04
@@ -279,6 +443,7 @@ def enable_native_ansi():
             )
             return False
 
+    _ansi_enabled = True
     return True
 
 
@@ -291,21 +456,28 @@ def make_short_hash(string):
 def diff(data1, data2):
     """Get diff of data2 and data1"""
     result = {}
-    for key in data1:
-        if key not in data2:
-            result[key] = data1[key]
-        else:
-            res = None
-            if isinstance(data1[key], dict) and isinstance(data2[key], dict):
-                res = diff(data1[key], data2[key])
-            elif data1[key] != data2[key]:
-                res = data1[key]
-            if res:
-                result[key] = res
-    for key in data2:
-        if key not in data1:
+    missing = object()
+    stack = [(result, data1, data2)]
+    nested = []
+    while stack:
+        res, left, right = stack.pop()
+        for key, value in left.items():
+            other = right.get(key, missing)
+            if other is missing:
+                res[key] = value
+            elif isinstance(value, dict) and isinstance(other, dict):
+                sub = res[key] = {}
+                nested.append((res, key, sub))
+                stack.append((sub, value, other))
+            elif value != other and value:
+                res[key] = value
+        for key in right.keys() - left.keys():
             # 已删除的节点
-            result[key] = "-"
+            res[key] = "-"
+    # Drop unchanged sub trees, deepest first
+    for res, key, sub in reversed(nested):
+        if not sub:
+            del res[key]
     return result
 
 
@@ -320,27 +492,42 @@ def win32_daemon():
 
 
 def safe_import(module_name, attr):
-    sys_path = sys.path
-    module = None
-    for path in sys_path:
-        sys.path = [path]
+    """Import the first module named module_name that provides attr"""
+    module = sys.modules.get(module_name)
+    if getattr(module, attr, None):
+        return module
+
+    specs = itertools.chain(
+        (importlib.machinery.BuiltinImporter.find_spec(module_name),),
+        (
+            importlib.machinery.PathFinder.find_spec(module_name, [path])
+            for path in sys.path
+        ),
+    )
+    previous = sys.modules.get(module_name)
+    for spec in specs:
+        if not spec:
+            continue
+        module = importlib.util.module_from_spec(spec)
+        # Registered before running, as the import system does, so that
+        # imports of itself or its submodules reuse this module object
+        sys.modules[module_name] = module
         try:
-            module = __import__(module_name)
+            spec.loader.exec_module(module)
         except ImportError:
             pass
         else:
             if getattr(module, attr, None):
-                break
-            else:
-                del sys.modules[module_name]
+                return module
+        if previous is None:
+            sys.modules.pop(module_name, None)
+        else:
+            sys.modules[module_name] = previous
 
-    sys.path = sys_path
-    if not module:
-        raise ImportError("No module named %r" % module_name)
-    return module
+    raise ImportError("No module named %r" % module_name)
 
 
 def write_stdout_inplace(content):
-    sys.stdout.write("\r" + " " * 80)
-    sys.stdout.write("\r" + content[:80])
+    clear_line = _CLEAR_LINE_ANSI if _ansi_enabled else _CLEAR_LINE
+    sys.stdout.write(clear_line + content[:80])
     sys.stdout.flush()
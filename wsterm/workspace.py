@@ -1,13 +1,29 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import collections
+import concurrent.futures
 import hashlib
+import itertools
 import os
 import pathlib
+import re
 import shutil
+import sys
+from stat import S_ISREG
 
 from . import aiowatch, gitignore_parser, utils
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+HASH_ALGO_MD5 = "md5"
+HASH_ALGO_BLAKE3 = "blake3"
+# Supported fingerprint algorithms, most preferred first
+HASH_ALGOS = (HASH_ALGO_BLAKE3, HASH_ALGO_MD5) if blake3 else (HASH_ALGO_MD5,)
+
 
 class EnumEvent(object):
     """Workspace event"""
@@ -23,6 +39,8 @@ class EnumEvent(object):
 
 
 class Directory(object):
+    __slots__ = ("_dir_path",)
+
     def __init__(self, dir_path):
         self._dir_path = dir_path
 
@@ -34,26 +52,40 @@ class Directory(object):
     def path(self):
         return self._dir_path
 
-    def get_dirs(self):
+    def get_children(self):
+        """Get sub directories and files with a single directory scan"""
         dir_list = []
-        for it in os.listdir(self._dir_path):
-            path = os.path.join(self._dir_path, it)
-            if os.path.isdir(path):
-                dir_list.append(Directory(path))
-        return dir_list
+        file_list = []
+        with os.scandir(self._dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dir_list.append(Directory(entry.path))
+                elif entry.is_file():
+                    file_list.append(File(entry.path, entry))
+        return dir_list, file_list
+
+    def get_dirs(self):
+        return self.get_children()[0]
 
     def get_files(self):
-        file_list = []
-        for it in os.listdir(self._dir_path):
-            path = os.path.join(self._dir_path, it)
-            if os.path.isfile(path):
-                file_list.append(File(path))
-        return file_list
+        return self.get_children()[1]
+
+
+def _new_md5():
+    if sys.version_info >= (3, 9):
+        # Content fingerprint only, allows the OpenSSL fast path on FIPS builds
+        return hashlib.md5(usedforsecurity=False)
+    return hashlib.md5()
 
 
 class File(object):
-    def __init__(self, file_path):
+    __slots__ = ("_file_path", "_dir_entry")
+
+    hash_chunk_size = 1024 * 1024
+
+    def __init__(self, file_path, dir_entry=None):
         self._file_path = file_path
+        self._dir_entry = dir_entry
 
     @property
     def name(self):
@@ -63,6 +95,12 @@ class File(object):
     def path(self):
         return self._file_path
 
+    def stat(self):
+        if self._dir_entry:
+            # Cached by the scan on Windows, saves a syscall per file
+            return self._dir_entry.stat()
+        return os.stat(self._file_path)
+
     @property
     def last_modify_time(self):
         return os.stat(self._file_path).st_mtime
@@ -73,20 +111,77 @@ class File(object):
 
     @property
     def hash(self):
-        m = hashlib.md5()
-        with open(self._file_path, "rb") as fp:
-            m.update(fp.read())
+        return self.get_hash(HASH_ALGO_MD5)
+
+    def get_hash(self, algo):
+        # Unbuffered, the hash loops read straight into their own buffer.
+        # Files are never memory mapped, a concurrent truncate would SIGBUS.
+        with open(self._file_path, "rb", buffering=0) as fp:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if algo == HASH_ALGO_BLAKE3:
+                # Single threaded, files are already hashed on a shared pool
+                m = blake3.blake3()
+            elif hasattr(hashlib, "file_digest"):
+                # Python 3.11+
+                return hashlib.file_digest(fp, _new_md5).hexdigest()
+            else:
+                m = _new_md5()
+            # Read into one reused buffer instead of a new bytes per chunk
+            buffer = bytearray(self.hash_chunk_size)
+            view = memoryview(buffer)
+            while True:
+                size = fp.readinto(buffer)
+                if not size:
+                    break
+                m.update(view[:size])
             return m.hexdigest()
 
 
+_hash_executor = None
+# Compiled ignore rules, replaced as a whole so readers on other threads
+# never see a half built set
+_IgnoreRules = collections.namedtuple(
+    "_IgnoreRules", ("rules", "names", "suffixes", "regex")
+)
+_PLAIN_NAME_PATTERN = re.compile(r"^[^*?\[\]\\!#/\s]+/?$")
+_GIT_SEGMENT = os.path.sep + ".git" + os.path.sep
+_PLAIN_SUFFIX_PATTERN = re.compile(r"^\*(\.[^*?\[\]\\!#/\s]+)$")
+
+
+def _get_hash_executor():
+    global _hash_executor
+    if _hash_executor is None:
+        _hash_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, (os.cpu_count() or 1) * 4),
+            thread_name_prefix="wsterm-hash",
+        )
+    return _hash_executor
+
+
 class Workspace(object):
-    def __init__(self, root_path, ignore_paths=None):
+    event_merge_delay = 0.02
+    small_file_size = 64 * 1024
+    hash_batch_file_size = 64 * 1024
+    hash_batch_count = 64
+
+    def __init__(self, root_path, ignore_paths=None, hash_algo=HASH_ALGO_MD5):
         self._root_path = os.path.realpath(root_path)
         if not os.path.isdir(self._root_path):
             os.makedirs(self._root_path)
         self._ignore_paths = ignore_paths
         self._handlers = []
-        self._ignore_rules = []
+        # event name => handler methods, rebuilt when handlers change
+        self._event_funcs = {}
+        self._pending_events = []
+        self._last_events = {}
+        self._flush_handle = None
+        self._ignore_base_path = pathlib.Path(self._root_path).resolve()
+        self._ignore = _IgnoreRules((), frozenset(), (), None)
+        self._gitignore_mtime = None
+        self._hash_algo = hash_algo
+        # path => ((mtime_ns, size, inode), hash)
+        self._hash_cache = {}
         self._build_ignore_rules()
         self._watcher = aiowatch.AIOWatcher(self._root_path, self)
         self._running = True
@@ -95,25 +190,79 @@ class Workspace(object):
     def path(self):
         return self._root_path
 
+    @property
+    def hash_algo(self):
+        return self._hash_algo
+
+    @hash_algo.setter
+    def hash_algo(self, algo):
+        if algo not in HASH_ALGOS:
+            raise ValueError("Unsupported hash algorithm %s" % algo)
+        if algo != self._hash_algo:
+            self._hash_algo = algo
+            self._hash_cache = {}
+
+    def _get_gitignore_mtime(self):
+        try:
+            stat = os.stat(os.path.join(self._root_path, ".gitignore"))
+        except OSError:
+            return None
+        return stat.st_mtime_ns if S_ISREG(stat.st_mode) else None
+
+    def _refresh_ignore_rules(self):
+        """Rebuild ignore rules only if .gitignore changed since last build"""
+        if self._get_gitignore_mtime() != self._gitignore_mtime:
+            self._build_ignore_rules()
+
     def _build_ignore_rules(self):
         gitignore_path = os.path.join(self._root_path, ".gitignore")
         ignore_text = ".git/\n.env*/\n*.pyc\n"
         if self._ignore_paths:
             for path in self._ignore_paths:
                 ignore_text += path + "\n"
-        if os.path.isfile(gitignore_path):
+        self._gitignore_mtime = self._get_gitignore_mtime()
+        if self._gitignore_mtime is not None:
             with open(gitignore_path) as fp:
                 ignore_text += fp.read()
 
+        rules = []
         for line in ignore_text.splitlines():
             if not line.strip():
                 continue
 
             rule = gitignore_parser.rule_from_pattern(
-                line, base_path=pathlib.Path(self._root_path).resolve(), source=None
+                line, base_path=self._ignore_base_path, source=None
             )
             if rule:
-                self._ignore_rules.append(rule)
+                rules.append(rule)
+
+        # Entries named exactly like a plain unanchored rule, e.g. node_modules/,
+        # can be skipped by name without resolving and matching the path
+        names = frozenset(
+            rule.pattern.rstrip("/")
+            for rule in rules
+            if not rule.negation and _PLAIN_NAME_PATTERN.match(rule.pattern)
+        )
+        # Files matching a plain extension rule, e.g. *.pyc, likewise
+        suffixes = tuple(
+            match.group(1)
+            for match in (
+                _PLAIN_SUFFIX_PATTERN.match(rule.pattern)
+                for rule in rules
+                if not rule.negation
+            )
+            if match
+        )
+
+        # Match all rules with one regex search on the relative path
+        patterns = []
+        for rule in rules:
+            regex = rule.regex
+            if regex.startswith("(?ms)"):
+                regex = regex[5:]
+            patterns.append("(?:%s)" % regex)
+        regex = re.compile("|".join(patterns), re.M | re.S) if patterns else None
+        self._ignore = _IgnoreRules(tuple(rules), names, suffixes, regex)
 
     def on_watch_filter(self, path):
         path = os.path.join(self._root_path, path)
@@ -135,73 +284,114 @@ class Workspace(object):
         return False
 
     def join_path(self, path):
-        return os.path.join(self._root_path, path.replace("/", os.path.sep))
+        if os.path.sep != "/":
+            path = path.replace("/", os.path.sep)
+        return os.path.join(self._root_path, path)
 
     def create_directory(self, path):
-        dir_path = os.path.join(self._root_path, path.replace("/", os.path.sep))
-        if not os.path.isdir(dir_path):
-            os.makedirs(dir_path)
+        os.makedirs(self.join_path(path), exist_ok=True)
 
     def remove_directory(self, path):
-        dir_path = os.path.join(self._root_path, path.replace("/", os.path.sep))
+        dir_path = self.join_path(path)
         if os.path.isdir(dir_path):
             shutil.rmtree(dir_path)
 
     def write_file(self, path, data, overwrite=True):
-        file_path = os.path.join(self._root_path, path.replace("/", os.path.sep))
-        dir_path = os.path.dirname(file_path)
-        if not os.path.isdir(dir_path):
-            os.makedirs(dir_path)
+        file_path = self.join_path(path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if len(data) < self.small_file_size:
+            # Most writes are small fragments, skip the buffered file object
+            flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+            flags |= os.O_TRUNC if overwrite else os.O_APPEND
+            fd = os.open(file_path, flags, 0o666)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view) :]
+            finally:
+                os.close(fd)
+            return
         flag = "wb" if overwrite else "ab"
         with open(file_path, flag) as fp:
             fp.write(data)
 
     def remove_file(self, path):
-        file_path = os.path.join(self._root_path, path.replace("/", os.path.sep))
+        file_path = self.join_path(path)
         if os.path.isfile(file_path):
             os.remove(file_path)
 
     def move_item(self, src_path, dst_path):
-        src_path = os.path.join(self._root_path, src_path.replace("/", os.path.sep))
-        dst_path = os.path.join(self._root_path, dst_path.replace("/", os.path.sep))
+        src_path = self.join_path(src_path)
+        dst_path = self.join_path(dst_path)
         if os.path.exists(src_path):
-            os.rename(src_path, dst_path)
+            os.replace(src_path, dst_path)
         else:
             utils.logger.warning("[%s] Path %s not exist" % (self.__class__.__name__, src_path))
 
     def set_perm(self, path, perm):
-        path = os.path.join(self._root_path, path.replace("/", os.path.sep))
+        path = self.join_path(path)
         if os.path.exists(path):
             os.chmod(path, perm)
 
     def register_handler(self, handler):
         self._handlers.append(handler)
+        self._event_funcs = {}
+
+    def _get_event_funcs(self, event_name):
+        funcs = self._event_funcs.get(event_name)
+        if funcs is None:
+            funcs = self._event_funcs[event_name] = [
+                func
+                for func in (getattr(handler, event_name) for handler in self._handlers)
+                if func
+            ]
+        return funcs
 
     def on_event(self, event_name, **kwargs):
         path = kwargs.get("path", kwargs.get("src_path"))
-        if path and ".git" in path.split(os.path.sep):
+        if path and ".git" in path and _GIT_SEGMENT in os.path.sep + path + os.path.sep:
+            return
+        event = (event_name, kwargs)
+        if self._last_events.get(path) == event:
+            # Same as the last pending event of this path, e.g. repeated writes
             return
-        for handler in self._handlers:
-            func = getattr(handler, event_name)
-            if func:
+        self._last_events[path] = event
+        self._pending_events.append(event)
+        if not self._flush_handle:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.event_merge_delay, self._flush_events
+            )
+
+    def _flush_events(self):
+        self._flush_handle = None
+        events = self._pending_events
+        self._pending_events = []
+        self._last_events = {}
+        for event_name, kwargs in events:
+            for func in self._get_event_funcs(event_name):
                 asyncio.ensure_future(func(**kwargs))
 
     def on_directory_created(self, path):
         self.on_event(EnumEvent.ON_DIRECTORY_CREATED, path=path)
 
     def on_directory_removed(self, path):
+        self._invalidate_hash(path)
         self.on_event(EnumEvent.ON_DIRECTORY_REMOVED, path=path)
 
     def on_file_created(self, path):
         self.on_event(EnumEvent.ON_FILE_CREATED, path=path)
 
     def on_file_modified(self, path):
+        self._invalidate_hash(path)
         self.on_event(EnumEvent.ON_FILE_MODIFIED, path=path)
 
     def on_file_removed(self, path):
+        self._invalidate_hash(path)
         self.on_event(EnumEvent.ON_FILE_REMOVED, path=path)
 
     def on_item_moved(self, src_path, dst_path):
+        self._invalidate_hash(src_path)
+        self._invalidate_hash(dst_path)
         self.on_event(EnumEvent.ON_ITEM_MOVED, src_path=src_path, dst_path=dst_path)
 
     def path_should_ignored(self, path):
@@ -210,18 +400,27 @@ class Workspace(object):
                 "[%s] Link path %s is ignored" % (self.__class__.__name__, path)
             )
             return True
-        for rule in self._ignore_rules:
-            if rule.match(path):
-                utils.logger.info(
-                    "[%s] Path %s ignored due to rule %s"
-                    % (self.__class__.__name__, path, rule)
-                )
-                return True
+        ignore = self._ignore
+        if not ignore.regex:
+            return False
+        rel_path = str(
+            pathlib.Path(path).resolve().relative_to(self._ignore_base_path)
+        )
+        if ignore.regex.search(rel_path.replace(os.sep, "/")):
+            # Find the matched rule only for logging
+            for rule in ignore.rules:
+                if rule.match(path):
+                    utils.logger.info(
+                        "[%s] Path %s ignored due to rule %s"
+                        % (self.__class__.__name__, path, rule)
+                    )
+                    break
+            return True
         return False
 
     def snapshot(self, root=None):
-        result = {"dirs": {}, "files": {}}
         root = root or self._root_path
+        self._refresh_ignore_rules()
         if os.path.isdir(root) and os.path.split(root)[-1] == ".git":
             # Auto ignore .git directory
             return
@@ -229,20 +428,80 @@ class Workspace(object):
         if self.path_should_ignored(root):
             return
 
-        root_dir = Directory(root)
-        for subdir in root_dir.get_dirs():
-            if self.path_should_ignored(subdir.path):
-                continue
-            res = self.snapshot(subdir.path)
-            if res:
-                result["dirs"][subdir.name] = res
-        for file in root_dir.get_files():
-            if self.path_should_ignored(file.path):
-                # Ignore current file
-                continue
-            result["files"][file.name] = file.hash
+        ignore = self._ignore
+        result = {"dirs": {}, "files": {}}
+        stack = [(root, result)]
+        pending = []  # Files changed since last snapshot
+        hash_cache = {}  # Hashes of the files seen by this snapshot
+        while stack:
+            path, node = stack.pop()
+            subdirs, files = Directory(path).get_children()
+            for subdir in subdirs:
+                if (
+                    subdir.name in ignore.names
+                    or subdir.name == ".git"
+                    or self.path_should_ignored(subdir.path)
+                ):
+                    continue
+                sub_node = node["dirs"][subdir.name] = {"dirs": {}, "files": {}}
+                stack.append((subdir.path, sub_node))
+            for file in files:
+                if (
+                    file.name in ignore.names
+                    or file.name.endswith(ignore.suffixes)
+                    or self.path_should_ignored(file.path)
+                ):
+                    # Ignore current file
+                    continue
+                stat = file.stat()
+                key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                cached = self._hash_cache.get(file.path)
+                if cached and cached[0] == key:
+                    node["files"][file.name] = cached[1]
+                    hash_cache[file.path] = cached
+                else:
+                    pending.append((node, file, key))
+
+        if len(pending) > 1:
+            # Overlap file reads, hashlib releases the GIL on large updates.
+            # Small files are hashed in ordered batches to save a pool task
+            # per file.
+            batches = []
+            batch = []
+            for it in pending:
+                large = it[2][1] >= self.hash_batch_file_size
+                if batch and (large or len(batch) >= self.hash_batch_count):
+                    batches.append(batch)
+                    batch = []
+                batch.append(it)
+                if large:
+                    batches.append(batch)
+                    batch = []
+            if batch:
+                batches.append(batch)
+            hashes = itertools.chain.from_iterable(
+                _get_hash_executor().map(
+                    lambda batch: [it[1].get_hash(self._hash_algo) for it in batch],
+                    batches,
+                )
+            )
+        else:
+            hashes = (it[1].get_hash(self._hash_algo) for it in pending)
+        for (node, file, key), file_hash in zip(pending, hashes):
+            node["files"][file.name] = file_hash
+            hash_cache[file.path] = (key, file_hash)
+        if root == self._root_path:
+            # Forget files which no longer exist
+            self._hash_cache = hash_cache
+        else:
+            self._hash_cache.update(hash_cache)
         return result
 
+    def _invalidate_hash(self, path):
+        # Entries under removed or moved directories are dropped by the
+        # next full snapshot, the stat key guards them until then
+        self._hash_cache.pop(self.join_path(path), None)
+
     async def watch(self):
         await self._watcher.start()
 